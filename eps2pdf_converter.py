@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 
-"""The main function in this module is the psfrag_replace function, which
+r"""The main function in this module is the psfrag_replace function, which
 is where the actual job is done.
 
  * Executing the module
@@ -26,10 +26,54 @@ If you need to use commands in the psfrag replacements that require extra
 latex packages, then create a file called 'extra_latex_packages.tex' or
 'NAME_extra_packages.tex' (the later will take precedence on the former if
 both exist) and put the '\usepackage{some package}' lines there.
+
+ * Overlay engine
+
+The psfrag_overlay function is an alternative to psfrag_replace. It uses
+ghostscript to convert the eps graphics to a PDF base layer with the psfrag
+tags removed (recording the position of each tag) and then uses pdflatex to
+typeset the replacements on top of that base layer. The base layer is
+cached in the 'NAME_psfrag_base.pdf' and 'NAME_psfrag_base.json' files and
+it is only regenerated when the eps file or the set of tags changes. That
+means that editing only the replacement texts just runs pdflatex.
+
+ * Stage limits
+
+Each external program run during the conversion (a "stage") is run with a
+wall-clock timeout and, optionally, with memory and CPU time limits (see
+DEFAULT_STAGE_LIMITS and run_stage). If a stage exceeds its timeout, the
+whole process group of the stage is killed and the conversion fails with
+the TIMEOUT_EXIT_CODE exit code.
 """
 
 import os
-from subprocess import call
+import re
+import json
+import hashlib
+import binascii
+import math
+import signal
+import resource
+import tempfile
+import time
+from subprocess import call, Popen
+
+
+# Exit code returned by run_stage when the stage times out (the same one
+# used by the timeout program from coreutils)
+TIMEOUT_EXIT_CODE = 124
+
+# Default limits for each stage of the conversion. The 'timeout' is the
+# wall-clock time (in seconds), 'memory' is the maximum address space (in
+# bytes) and 'cpu' is the maximum CPU time (in seconds). A value of None
+# (or 0) means no limit. The 'gs' stage is used for ghostscript, both when
+# it is run directly and through ps2pdf.
+DEFAULT_STAGE_LIMITS = {
+    "latex": {"timeout": 600, "memory": None, "cpu": None},
+    "dvips": {"timeout": 600, "memory": None, "cpu": None},
+    "pdfcrop": {"timeout": 600, "memory": None, "cpu": None},
+    "gs": {"timeout": 600, "memory": None, "cpu": None},
+    "pdflatex": {"timeout": 600, "memory": None, "cpu": None}}
 
 
 def get_extra_packages(name):
@@ -169,13 +213,221 @@ def psfragListToString(psfragList):
     return psfragText.strip()
 
 
-def crop_pdf(filename):
+def _is_escaped(text, index):
+    """Return True if the character at `index` in `text` is escaped, that
+    is, if it is preceded by an odd number of backslashes.
+    """
+    backslashes = 0
+    while index - backslashes > 0 and text[index - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+def _remove_comments(text):
+    """Remove everything after a '%' (that is not escaped) in each line of
+    `text`.
+    """
+    lines = []
+    for line in text.split("\n"):
+        for match in re.finditer("%", line):
+            if not _is_escaped(line, match.start()):
+                line = line[:match.start()]
+                break
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _read_group(text, index, opening, closing):
+    """Read the group that starts at `index` in `text` (which must be the
+    `opening` character) and return a tuple with the group content (without
+    the delimiters) and the index just after the group.
+
+    Nested groups with the same delimiters are allowed.
+    """
+    if text[index:index + 1] != opening:
+        raise ValueError("Expected '{0}' in the psfrag replacements".format(opening))
+    depth = 0
+    for i in range(index, len(text)):
+        if text[i] == opening and not _is_escaped(text, i):
+            depth += 1
+        elif text[i] == closing and not _is_escaped(text, i):
+            depth -= 1
+            if depth == 0:
+                return (text[index + 1:i], i + 1)
+    raise ValueError("Unbalanced '{0}' in the psfrag replacements".format(opening))
+
+
+def psfragStringToList(psfragText):
+    """
+    Convert a string with psfrag commands to a list of lists of strings.
+
+    This is the inverse of psfragListToString. As an example, the string
+    : \\psfrag{BER}[cc][cc]{BER}
+    : \\psfrag{Eb/N0}{$Eb/N_{0}$}
+    will be converted to
+    : [['BER', 'BER', '[cc][cc]']
+    :  ['Eb/N0', '$Eb/N_{0}$', '']]
+
+    As in latex, everything after a '%' in a line is ignored and only the
+    \\psfrag command is considered (not \\psfragscanon, etc).
+
+    A ValueError is raised if a psfrag command is malformed.
+
+    Parameters
+    ----------
+    psfragText : str
+        String with the psfrag commands.
+    """
+    # Remove the comments
+    psfragText = _remove_comments(psfragText)
+
+    psfragList = []
+    psfragCommand = re.compile(r"\\psfrag\s*(?=\{)")
+    match = psfragCommand.search(psfragText)
+    while match is not None:
+        index = match.end()
+        (tag, index) = _read_group(psfragText, index, '{', '}')
+
+        options = ""
+        index = index + len(psfragText[index:]) - len(psfragText[index:].lstrip())
+        while psfragText[index:index + 1] == '[':
+            (option, index) = _read_group(psfragText, index, '[', ']')
+            options = options + "[{0}]".format(option)
+            index = index + len(psfragText[index:]) - len(psfragText[index:].lstrip())
+
+        (replacement, index) = _read_group(psfragText, index, '{', '}')
+        psfragList.append([tag, replacement, options])
+        match = psfragCommand.search(psfragText, index)
+    return psfragList
+
+
+def get_stage_limits(stage, limits=None):
+    """Return a dictionary with the 'timeout', 'memory' and 'cpu' limits of
+    the stage `stage`.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage (one of the keys in DEFAULT_STAGE_LIMITS).
+    limits : dict
+        Dictionary mapping stage names to dictionaries with the limits that
+        should override the ones in DEFAULT_STAGE_LIMITS. Limits equal to
+        None are ignored.
+        Ex:
+        {'latex': {'timeout': 30}, 'gs': {'memory': 2 * 1024 ** 3}}
+    """
+    stage_limits = dict(DEFAULT_STAGE_LIMITS.get(stage, {}))
+    if limits is not None:
+        for (key, value) in limits.get(stage, {}).items():
+            if value is not None:
+                stage_limits[key] = value
+    return stage_limits
+
+
+def _kill_process_group(process, grace_period=5):
+    """Terminate the process group of `process`, kill it if `process` does
+    not terminate in `grace_period` seconds and wait for `process`.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        # The process group does not exist anymore
+        pass
+    deadline = time.time() + grace_period
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    # Kill whatever is still running in the process group, even if
+    # `process` itself already terminated
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
+
+def run_stage(stage, shell_command, limits=None, capture_output=False):
+    """Run the shell command of a conversion stage with the stage limits.
+
+    The command is run in a new process group (session) with the memory
+    and CPU limits of the stage. If it does not finish before the stage
+    timeout, the whole process group is terminated (and killed if it does
+    not terminate in a few seconds) and TIMEOUT_EXIT_CODE is returned. The
+    process group is also killed if an exception (such as a
+    KeyboardInterrupt) is raised while waiting for the command.
+
+    Return a tuple with the exit code and the standard output of the
+    command (None if `capture_output` is False).
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage (one of the keys in DEFAULT_STAGE_LIMITS).
+    shell_command : str
+        The command to be run.
+    limits : dict
+        The limits that should override the default ones (see
+        get_stage_limits).
+    capture_output : bool
+        If True, the standard output of the command is captured and
+        returned.
+    """
+    stage_limits = get_stage_limits(stage, limits)
+
+    def start_stage():
+        """Create a new session and set the resource limits in the child
+        process."""
+        os.setsid()
+        if stage_limits.get("memory"):
+            memory = int(stage_limits["memory"])
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        if stage_limits.get("cpu"):
+            cpu = int(stage_limits["cpu"])
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 5))
+
+    # The output is written to a temporary file instead of a pipe, since a
+    # full pipe would block the command while we are not reading it
+    output_file = tempfile.TemporaryFile() if capture_output else None
+    process = Popen(shell_command, shell=True, stdout=output_file,
+                    preexec_fn=start_stage)
+
+    timeout = stage_limits.get("timeout")
+    deadline = time.time() + timeout if timeout else None
+    timed_out = False
+    try:
+        while process.poll() is None:
+            if deadline is not None and time.time() > deadline:
+                timed_out = True
+                break
+            time.sleep(0.05)
+    except BaseException:
+        # Do not leave the stage running (Ex: after a KeyboardInterrupt)
+        _kill_process_group(process)
+        raise
+
+    if timed_out:
+        print("The {0} stage timed out after {1} seconds".format(stage, timeout))
+        _kill_process_group(process)
+        exit_code = TIMEOUT_EXIT_CODE
+    else:
+        exit_code = process.returncode
+
+    output = None
+    if output_file is not None:
+        output_file.seek(0)
+        output = output_file.read().decode('utf-8', 'replace')
+        output_file.close()
+    return (exit_code, output)
+
+
+def crop_pdf(filename, limits=None):
     """Call the pdfcrop program to crop a PDF file.
 
     Parameters
     ----------
     filename : str
         The name of the PDF file (with the extension).
+    limits : dict
+        The stage limits (see get_stage_limits).
     """
     import os
     basename, extension = os.path.splitext(filename)
@@ -193,11 +445,16 @@ def crop_pdf(filename):
     # Crop the PDF file
     SHELL_COMMAND_CROP_PDF_FILE = r"pdfcrop {0} {1} > /dev/null".format(aux_filename, filename)
 
-    exit_code = call(SHELL_COMMAND_CROP_PDF_FILE, shell=True)
-    os.remove(aux_filename)
+    (exit_code, output) = run_stage("pdfcrop", SHELL_COMMAND_CROP_PDF_FILE, limits)
+    if exit_code == 0:
+        os.remove(aux_filename)
+    else:
+        # Keep the uncropped PDF file
+        os.rename(aux_filename, filename)
+    return exit_code
 
 
-def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=True):
+def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=True, limits=None):
     """
     Perform the psfrag replacements in an eps file.
 
@@ -220,6 +477,10 @@ def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=Tru
         (INCLUDING THE BRACKETS).
     crop : boll
         If True, the final PDF will be cropped using the pdfcrop program.
+    limits : dict
+        The limits of the 'latex', 'dvips', 'gs' (ps2pdf) and 'pdfcrop'
+        stages that should override the ones in DEFAULT_STAGE_LIMITS (see
+        get_stage_limits).
     """
     (directory, filename) = os.path.split(figureFullName)
     # If the file name is a full path, change current working directory to
@@ -242,7 +503,8 @@ def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=Tru
 
     shell_command_latex = "latex -halt-on-error -interaction=batchmode {0} > /dev/null".format(tex_fileName)
     # Option '-q' in dvips is for the quiet mode
-    shell_command_dvi_to_pdf = "dvips -q {0} && ps2pdf {1} {2}.pdf".format(dvi_fileName, ps_fileName, filename)
+    shell_command_dvips = "dvips -q {0}".format(dvi_fileName)
+    shell_command_ps2pdf = "ps2pdf {0} {1}.pdf".format(ps_fileName, filename)
 
     # Called to remove the generated temporary (latex related) files.
     shell_command_remove_temporary_files = "rm -f {0}.*".format(fileName)
@@ -252,7 +514,7 @@ def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=Tru
     shell_command_remove_debug_files = "rm -f {0}_debug.*".format(fileName)
 
     print ("xxxxxxxxxx RUNNING LATEX xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
-    exit_code = call(shell_command_latex, shell=True)
+    (exit_code, output) = run_stage("latex", shell_command_latex, limits)
     print("Latex exit code is: {0}".format(exit_code))
     if(exit_code != 0):  # Latex file could not be processed
         os.rename(tex_fileName, tex_fileName_debug)
@@ -272,7 +534,10 @@ def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=Tru
     # If latex processing was ok we just need to convert to ps and then to
     # pdf (as well as removing the temporary files)
     print ("xxxxxxxxxx RUNNING DVIPS AND PS2PDF xxxxxxxxxxxxxxxxxxxxxxxx")
-    dvi_to_pdf_exit_code = call(shell_command_dvi_to_pdf, shell=True)
+    (dvi_to_pdf_exit_code, output) = run_stage("dvips", shell_command_dvips, limits)
+    if dvi_to_pdf_exit_code == 0:
+        # ps2pdf runs ghostscript, so it uses the limits of the 'gs' stage
+        (dvi_to_pdf_exit_code, output) = run_stage("gs", shell_command_ps2pdf, limits)
 
     if dvi_to_pdf_exit_code != 0:
         os.rename(tex_fileName, tex_fileName_debug)
@@ -282,7 +547,13 @@ def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=Tru
         # is to crop the PDF to remove the whitespace if the 'crop'
         # argument is True.
         if crop is True:
-            crop_pdf(filename)
+            crop_exit_code = crop_pdf(filename, limits)
+            if crop_exit_code != 0:
+                print("The PDF file could not be cropped (pdfcrop exit code: {0})".format(crop_exit_code))
+            # An uncropped PDF file is still a successful conversion,
+            # unless pdfcrop timed out
+            if crop_exit_code == TIMEOUT_EXIT_CODE:
+                dvi_to_pdf_exit_code = crop_exit_code
 
     print("dvips or ps2pdf exit code: {0}".format(dvi_to_pdf_exit_code))
     print ("xxxxxxxxxx REMOVING TEMPORARY FILES xxxxxxxxxxxxxxxxxxxxxxxx")
@@ -292,6 +563,429 @@ def psfrag_replace(figureFullName, psfrags, includegraphics_options="", crop=Tru
     return dvi_to_pdf_exit_code
 
 
+# PostScript code run by ghostscript before the eps file when creating the
+# base layer of the overlay engine. It redefines the show operator so that
+# the strings in the psfrag_tags dictionary (created in
+# prepareBaseLayerProlog) are not painted. Instead, the position of the
+# string is printed in a line starting with "%%PSFRAG" with the following
+# values (in the PDF default coordinates, i.e., in bp):
+#     tag_index x y angle width depth height
+# where (x,y) is the left point in the baseline of the string and angle is
+# the rotation of the baseline (in degrees, counterclockwise).
+BASE_LAYER_PROLOG = r"""
+/psfrag_dict 20 dict def
+/psfrag_show /show load def
+/psfrag_num { 32 string cvs print ( ) print } bind def
+/psfrag_todefault { transform matrix defaultmatrix itransform } bind def
+/show {
+  psfrag_tags 1 index known {
+    psfrag_dict begin
+      /str exch def
+      /idx psfrag_tags str get def
+      currentpoint /cy exch def /cx exch def
+      cx cy psfrag_todefault /oy exch def /ox exch def
+      str stringwidth cy add exch cx add exch psfrag_todefault
+      /ey exch def /ex exch def
+      ex ox sub dup mul ey oy sub dup mul add sqrt /wd exch def
+      wd 0 gt { ey oy sub ex ox sub atan } { 0 } ifelse /ang exch def
+      gsave
+        newpath cx cy moveto str false charpath
+        matrix defaultmatrix setmatrix ox oy translate ang rotate
+        { flattenpath pathbbox } stopped { 0 0 0 0 } if
+        /ury exch def pop /lly exch def pop
+      grestore
+      (%%PSFRAG ) print
+      idx psfrag_num ox psfrag_num oy psfrag_num ang psfrag_num
+      wd psfrag_num lly neg psfrag_num ury psfrag_num
+      (\n) print flush
+      str stringwidth rmoveto
+    end
+  } {
+    psfrag_show
+  } ifelse
+} bind def
+"""
+
+
+def _tag_bytes(tag):
+    """Return the bytes of the psfrag tag `tag` as they are in the eps file.
+    """
+    if isinstance(tag, bytes):
+        # Python 2 strings are already encoded
+        return tag
+    try:
+        return tag.encode('latin-1')
+    except UnicodeError:
+        return tag.encode('utf-8')
+
+
+def prepareBaseLayerProlog(tags):
+    """
+    Prepare the PostScript prolog used to create the base layer of the
+    overlay engine.
+
+    Parameters
+    ----------
+    tags : list of strings
+        The psfrag tags (original texts in the eps file) that should be
+        removed from the base layer.
+    """
+    entries = []
+    for (index, tag) in enumerate(tags):
+        hex_tag = binascii.hexlify(_tag_bytes(tag)).decode('ascii')
+        entries.append("<{0}> {1}".format(hex_tag, index))
+    tags_dict = "/psfrag_tags << {0} >> def".format(" ".join(entries))
+    return tags_dict + "\n" + BASE_LAYER_PROLOG
+
+
+def parsePsfragOptions(options):
+    """
+    Parse the optional arguments of a psfrag command.
+
+    Return a tuple (posn, psposn, scale, rot) with the placement of the
+    replacement, the placement in the original text, the scale and the
+    rotation (in degrees) of the replacement. The default values are the
+    same ones used by the psfrag package, that is, 'Bl' for posn, posn
+    for psposn, 1 for scale and 0 for rot.
+
+    A ValueError is raised if the scale or the rotation is not a number.
+
+    Parameters
+    ----------
+    options : str
+        The optional arguments (Ex: "[cc][cc]" - without the quotes).
+    """
+    values = re.findall(r"\[([^\]]*)\]", options)
+    values = values + [""] * (4 - len(values))
+    posn = values[0].strip() or "Bl"
+    psposn = values[1].strip() or posn
+    try:
+        scale = float(values[2]) if values[2].strip() else 1.0
+        rot = float(values[3]) if values[3].strip() else 0.0
+    except ValueError:
+        raise ValueError("Invalid psfrag options '{0}'".format(options))
+    return (posn, psposn, scale, rot)
+
+
+def _placement(posn):
+    """Return the horizontal position ('l', 'c' or 'r') and the vertical
+    position ('t', 'c', 'b' or 'B') in a psfrag placement such as "cc" or
+    "Bl".
+    """
+    horizontal = 'c'
+    vertical = 'c'
+    for letter in posn:
+        if letter in 'lr':
+            horizontal = letter
+        elif letter in 'tbB':
+            vertical = letter
+    return (horizontal, vertical)
+
+
+def tagAnchor(position, psposn):
+    """
+    Return the (x, y) coordinates of the `psposn` point of a tag in the
+    base layer.
+
+    Parameters
+    ----------
+    position : list
+        The position of the tag as recorded by createBaseLayer, that is, a
+        list with the values [x, y, angle, width, depth, height].
+    psposn : str
+        The point of the original text where the replacement is placed
+        (Ex: "cc", "Bl", "tr").
+    """
+    (x, y, angle, width, depth, height) = position
+    (horizontal, vertical) = _placement(psposn)
+    dx = {'l': 0.0, 'c': width / 2.0, 'r': width}[horizontal]
+    dy = {'t': height, 'c': (height - depth) / 2.0,
+          'b': -depth, 'B': 0.0}[vertical]
+    angle = math.radians(angle)
+    return (x + dx * math.cos(angle) - dy * math.sin(angle),
+            y + dx * math.sin(angle) + dy * math.cos(angle))
+
+
+def createBaseLayer(filename, tags, limits=None):
+    """
+    Convert the eps file to the PDF base layer of the overlay engine.
+
+    The base layer is saved in the 'NAME_psfrag_base.pdf' file and the
+    positions of the tags are saved in the 'NAME_psfrag_base.json' file.
+    If these files already exist and were created from the same eps file
+    with the same tags then nothing is done.
+
+    Return a tuple with the exit code of ghostscript (0 if the cached base
+    layer was used) and a dictionary mapping each tag to a list with the
+    positions where it was found. Each position is a list with the values
+    [x, y, angle, width, depth, height] (see BASE_LAYER_PROLOG).
+
+    Parameters
+    ----------
+    filename : str
+        Name of the eps file (without extension)
+    tags : list of strings
+        The psfrag tags that should be removed from the base layer.
+    limits : dict
+        The stage limits (see get_stage_limits).
+    """
+    baseName = "{0}_psfrag_base".format(filename)
+    pdf_fileName = "{0}.pdf".format(baseName)
+    json_fileName = "{0}.json".format(baseName)
+    prolog_fileName = "{0}_prolog.ps".format(baseName)
+
+    # The cache key depends on the eps content and on the tags, but not on
+    # the replacements
+    md5 = hashlib.md5()
+    fId = open("{0}.eps".format(filename), 'rb')
+    md5.update(fId.read())
+    fId.close()
+    md5.update(b"\0".join(sorted(_tag_bytes(tag) for tag in tags)))
+    key = md5.hexdigest()
+
+    try:
+        fId = open(json_fileName)
+        cache = json.load(fId)
+        fId.close()
+        if cache["key"] == key and os.path.exists(pdf_fileName):
+            print("Using cached base layer {0}".format(pdf_fileName))
+            return (0, cache["positions"])
+    except (IOError, ValueError, KeyError):
+        # There is no (valid) cached base layer
+        pass
+
+    f = open(prolog_fileName, 'w')
+    f.write(prepareBaseLayerProlog(tags))
+    f.close()
+
+    shell_command_gs = "gs -q -dNOPAUSE -dBATCH -sDEVICE=pdfwrite -dEPSCrop -sOutputFile={0} {1} {2}.eps".format(pdf_fileName, prolog_fileName, filename)
+    (exit_code, output) = run_stage("gs", shell_command_gs, limits, capture_output=True)
+    os.remove(prolog_fileName)
+
+    positions = dict((tag, []) for tag in tags)
+    for line in output.splitlines():
+        if line.startswith("%%PSFRAG "):
+            values = line.split()[1:]
+            positions[tags[int(values[0])]].append([float(v) for v in values[1:]])
+
+    if exit_code == 0:
+        f = open(json_fileName, 'w')
+        json.dump({"key": key, "positions": positions}, f)
+        f.close()
+
+    return (exit_code, positions)
+
+
+def prepareOverlayLatexCode(figureName, psfragList, positions, includegraphics_options=""):
+    """
+    Prepare the latex code used to typeset the psfrag replacements on top of
+    the base layer.
+
+    Parameters
+    ----------
+    figureName : str
+        Name of the eps file (without extension)
+    psfragList : list
+        List with the psfrag replacements (see psfragStringToList).
+    positions : dict
+        Dictionary mapping each tag to a list with its positions, as
+        returned by createBaseLayer.
+    includegraphics_options : str
+        Options that should be passed to the includegraphics package
+        (INCLUDING THE BRACKETS). Only the options that scale the figure
+        are supported (see OVERLAY_UNSUPPORTED_OPTIONS).
+    """
+    latex_code = """
+\\documentclass{{article}}
+\\usepackage{{graphicx,color}}
+\\usepackage[english]{{babel}}
+\\usepackage[utf8]{{inputenc}}
+{EXTRAPACKAGES}
+\\setlength{{\\topmargin}}{{0in}}
+\\setlength{{\\headheight}}{{0pt}}
+\\setlength{{\\headsep}}{{0pt}}
+\\setlength{{\\topskip}}{{0pt}}
+\\setlength{{\\textheight}}{{\\paperheight}}
+\\setlength{{\\oddsidemargin}}{{0in}}
+\\setlength{{\\evensidemargin}}{{0in}}
+\\setlength{{\\textwidth}}{{\\paperwidth}}
+\\setlength{{\\parindent}}{{0pt}}
+\\pagestyle{{empty}}
+\\newsavebox{{\\psfragbase}}
+\\newsavebox{{\\psfragnatural}}
+\\newsavebox{{\\psfraglabel}}
+\\newlength{{\\psfragdx}}
+\\newlength{{\\psfragdy}}
+\\newlength{{\\psfragx}}
+\\newlength{{\\psfragy}}
+\\newlength{{\\psfragxunit}}
+\\newlength{{\\psfragyunit}}
+%% \\psfragput{{x}}{{y}}{{angle}}{{hfrac}}{{htfrac}}{{dpfrac}}{{scale}}{{text}}
+\\newcommand{{\\psfragput}}[8]{{%
+  \\sbox{{\\psfraglabel}}{{\\scalebox{{#7}}{{#8}}}}%
+  \\setlength{{\\psfragx}}{{#1\\psfragxunit}}%
+  \\setlength{{\\psfragy}}{{#2\\psfragyunit}}%
+  \\setlength{{\\psfragdx}}{{-#4\\wd\\psfraglabel}}%
+  \\setlength{{\\psfragdy}}{{-#5\\ht\\psfraglabel}}%
+  \\addtolength{{\\psfragdy}}{{#6\\dp\\psfraglabel}}%
+  \\put(0,0){{\\makebox[0pt][l]{{\\hspace*{{\\psfragx}}\\raisebox{{\\psfragy}}[0pt][0pt]{{\\rotatebox{{#3}}{{\\makebox[0pt][l]{{\\hspace*{{\\psfragdx}}\\raisebox{{\\psfragdy}}[0pt][0pt]{{\\usebox{{\\psfraglabel}}}}}}}}}}}}}}}}
+
+\\begin{{document}}
+\\sbox{{\\psfragbase}}{{\\includegraphics{INCLUDEGRAPHICS_OPTIONS}{{{BASENAME}}}}}%
+\\sbox{{\\psfragnatural}}{{\\includegraphics{{{BASENAME}}}}}%
+%% The horizontal and vertical scales of the base layer can be different
+%% (Ex: [width=5cm,height=3cm])
+\\setlength{{\\psfragxunit}}{{\\dimexpr 1bp*\\wd\\psfragbase/\\wd\\psfragnatural\\relax}}%
+\\setlength{{\\psfragyunit}}{{\\dimexpr 1bp*\\ht\\psfragbase/\\ht\\psfragnatural\\relax}}%
+\\usebox{{\\psfragbase}}\\hspace*{{-\\wd\\psfragbase}}%
+\\begin{{picture}}(0,0)
+{LABELS}
+\\end{{picture}}
+\\end{{document}}"""
+    if includegraphics_options == "":
+        includegraphics_options = "[scale=1]"
+
+    # Fraction of the width, height and depth of the replacement used to
+    # shift it according to its placement
+    hfrac = {'l': '0', 'c': '0.5', 'r': '1'}
+    vfrac = {'t': ('1', '0'), 'c': ('0.5', '0.5'),
+             'b': ('0', '1'), 'B': ('0', '0')}
+
+    labels = []
+    for (tag, replacement, options) in psfragList:
+        (posn, psposn, scale, rot) = parsePsfragOptions(options)
+        (horizontal, vertical) = _placement(posn)
+        for position in positions.get(tag, []):
+            (x, y) = tagAnchor(position, psposn)
+            labels.append("\\psfragput{{{0:.3f}}}{{{1:.3f}}}{{{2:.3f}}}{{{3}}}{{{4}}}{{{5}}}{{{6}}}{{{7}}}".format(
+                x, y, position[2] + rot, hfrac[horizontal],
+                vfrac[vertical][0], vfrac[vertical][1], scale, replacement))
+
+    all_replacements = {"LABELS": "\n".join(labels),
+                        "BASENAME": "{0}_psfrag_base.pdf".format(figureName),
+                        "INCLUDEGRAPHICS_OPTIONS": includegraphics_options,
+                        "EXTRAPACKAGES": get_extra_packages(figureName)}
+    latex_code = latex_code.format(**all_replacements)
+    return latex_code
+
+
+# The includegraphics options that can not be used with the overlay engine,
+# since they rotate or cut the base layer and the position of the
+# replacements would be wrong.
+OVERLAY_UNSUPPORTED_OPTIONS = ["angle", "origin", "trim", "viewport", "bb"]
+
+
+def psfrag_overlay(figureFullName, psfrags, includegraphics_options="", crop=True, limits=None):
+    """
+    Perform the psfrag replacements in an eps file using the overlay engine.
+
+    This has the same parameters and return value as psfrag_replace, but
+    instead of running latex, dvips and ps2pdf it converts the eps graphics
+    (without the psfrag tags) to a cached PDF base layer with ghostscript
+    and then typesets the replacements on top of it with pdflatex. If only
+    the replacements changed since the last conversion then only pdflatex
+    is run.
+
+    Parameters
+    ----------
+    figureFullName : str
+        Name of the eps file (without extension).
+    psfrags : string or a list of strings
+        The psfrag replacements (see prepareLatexCode).
+    includegraphics_options : str
+        Options that should be passed to the includegraphics package
+        (INCLUDING THE BRACKETS). Only the options that scale the figure
+        (such as scale, width, height and keepaspectratio) are supported.
+    crop : boll
+        If True, the final PDF will be cropped using the pdfcrop program.
+    limits : dict
+        The limits of the 'gs', 'pdflatex' and 'pdfcrop' stages that should
+        override the ones in DEFAULT_STAGE_LIMITS (see get_stage_limits).
+    """
+    (directory, filename) = os.path.split(figureFullName)
+    # If the file name is a full path, change current working directory to
+    # the directory containing the eps file
+    if (directory):
+        os.chdir(directory)
+
+    for option in OVERLAY_UNSUPPORTED_OPTIONS:
+        if re.search(r"\b{0}\b".format(option), includegraphics_options):
+            print("The includegraphics option '{0}' is not supported by the overlay engine. Use the psfrag engine instead.".format(option))
+            return 1
+
+    if not os.path.exists("{0}.eps".format(filename)):
+        print("The file {0}.eps does not exist".format(filename))
+        return 1
+
+    try:
+        if(isinstance(psfrags, list)):
+            psfragList = psfrags
+        else:
+            psfragList = psfragStringToList(psfrags)
+        # Check the optional arguments of all psfrag commands
+        for (tag, replacement, options) in psfragList:
+            parsePsfragOptions(options)
+    except ValueError as e:
+        print("The psfrag replacements could not be parsed: {0}".format(e))
+        return 1
+    tags = [i[0] for i in psfragList]
+
+    print ("xxxxxxxxxx CREATING BASE LAYER xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+    (gs_exit_code, positions) = createBaseLayer(filename, tags, limits)
+    print("Ghostscript exit code is: {0}".format(gs_exit_code))
+    if gs_exit_code != 0:
+        print("The base layer could not be created. Run ghostscript on the file {0}.eps manually to get some clue about the problem.".format(filename))
+        return gs_exit_code
+    for tag in tags:
+        if not positions.get(tag):
+            print("Warning: The tag '{0}' was not found in the eps file".format(tag))
+
+    latex_code = prepareOverlayLatexCode(filename, psfragList, positions, includegraphics_options)
+
+    # Open file to save latex code
+    fileName = "{0}_psfrag_overlay".format(filename)
+    tex_fileName = "{0}.tex".format(fileName)
+    tex_fileName_debug = "{0}_debug.tex".format(fileName) # This will only be used whem compilation fail
+    f = open(tex_fileName, 'w')
+    f.write(latex_code)
+    f.close()
+
+    pdf_fileName = "{0}.pdf".format(fileName)
+    shell_command_pdflatex = "pdflatex -halt-on-error -interaction=batchmode {0} > /dev/null".format(tex_fileName)
+
+    # Called to remove the generated temporary (latex related) files.
+    shell_command_remove_temporary_files = "rm -f {0}.*".format(fileName)
+
+    # Called to remove the generated debug (latex related) files after a
+    # successful compilation.
+    shell_command_remove_debug_files = "rm -f {0}_debug.*".format(fileName)
+
+    print ("xxxxxxxxxx RUNNING PDFLATEX xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+    (exit_code, output) = run_stage("pdflatex", shell_command_pdflatex, limits)
+    print("Pdflatex exit code is: {0}".format(exit_code))
+    if(exit_code != 0):  # Latex file could not be processed
+        os.rename(tex_fileName, tex_fileName_debug)
+        print("The tex file could not be compiled. Compile the file {0} manually to get some clue about the problem.".format(tex_fileName_debug))
+    else:
+        # Remove debug files (from a possibly unsuccessful compilation)
+        call(shell_command_remove_debug_files, shell=True)
+        os.rename(pdf_fileName, "{0}.pdf".format(filename))
+        if crop is True:
+            crop_exit_code = crop_pdf(filename, limits)
+            if crop_exit_code != 0:
+                print("The PDF file could not be cropped (pdfcrop exit code: {0})".format(crop_exit_code))
+            # An uncropped PDF file is still a successful conversion,
+            # unless pdfcrop timed out
+            if crop_exit_code == TIMEOUT_EXIT_CODE:
+                exit_code = crop_exit_code
+
+    print ("xxxxxxxxxx REMOVING TEMPORARY FILES xxxxxxxxxxxxxxxxxxxxxxxx")
+    rm_exit_code = call(shell_command_remove_temporary_files, shell=True)
+    print("Remove files exit code: {0}".format(rm_exit_code))
+
+    return exit_code
+
+
 def print_help():
     help = """Usage: eps2pdf_converter fileName psfragsFileName
        - filename is the name of the eps file (without extension)
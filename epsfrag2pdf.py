@@ -4,7 +4,8 @@
 """module docstring"""
 
 import argparse
-from eps2pdf_converter import psfrag_replace
+import sys
+from eps2pdf_converter import psfrag_replace, psfrag_overlay, DEFAULT_STAGE_LIMITS
 import os
 from glob import glob
 
@@ -37,25 +38,47 @@ def read_psfrags_file(name):
     return (psfrag_text, includegraphics_options)
 
 
-def process_files(files):
+def process_files(files, engine="psfrag", limits=None):
     """Call the psfrag_replace method for each file in `files`.
 
+    A file whose conversion fails (including when one of the stages times
+    out) does not stop the processing of the remaining files.
+
     Arguments:
     - `files`: list with file names.
+    - `engine`: "psfrag" to use the psfrag_replace method or "overlay" to
+      use the psfrag_overlay method.
+    - `limits`: the stage limits passed to the conversion method (see
+      get_stage_limits in the eps2pdf_converter module).
+    Output:
+    - A dictionary mapping each file name to the exit code of its
+      conversion (0 means success).
     """
+    convert = psfrag_overlay if engine == "overlay" else psfrag_replace
 
+    results = {}
     for filename in files:
         print("Process File: {0}".format(filename))
         (psfrag_text, includegraphics_options) = read_psfrags_file(filename)
-        psfrag_replace(filename, psfrag_text, includegraphics_options)
+        results[filename] = convert(filename, psfrag_text, includegraphics_options, limits=limits)
         print("\n")
 
+    failed = [filename for filename in files if results[filename] != 0]
+    if failed:
+        print("The conversion failed for the files:\n{0}".format("\n".join(failed)))
+    return results
+
 
-def process_folders(folders):
+def process_folders(folders, engine="psfrag", limits=None):
     """Call the psfrag_replace on every file (with a corresponding .psfrags file) in every folder in `folders`.
 
     Arguments:
     - `folders`: list with folder names
+    - `engine`: the conversion engine (see process_files)
+    - `limits`: the stage limits (see process_files)
+    Output:
+    - A dictionary mapping each file name to the exit code of its
+      conversion (0 means success).
     """
     def get_absolute_path(path):
         """Expand '~', ".", "..", etc. and return the absolute path.
@@ -66,6 +89,7 @@ def process_folders(folders):
         "Get a list with the file names of all '*.psgrags' files."
         return glob("{0}/*.psfrags".format(folder))
 
+    results = {}
     # Process each folder in fodlers
     for folder in folders:
         # Expand especial characters in folder (such as '~' or '.')
@@ -78,7 +102,9 @@ def process_folders(folders):
         files = [i[:-8] for i in files]
 
         # Finally, process all the files
-        process_files(files)
+        results.update(process_files(files, engine, limits))
+
+    return results
 
 
 # xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
@@ -87,21 +113,38 @@ if __name__ == '__main__':
 
     parser.add_argument("-F", "--folder", help="Use folder mode instead of file mode. In folder mode the arguments are treated as folder names instead of file names and all the eps files in the folder that have a bundled .psfrags file are processed.", action="store_true", dest="folder_mode")
 
+    parser.add_argument("-e", "--engine", help="Conversion engine. The 'psfrag' engine (default) runs latex, dvips and ps2pdf. The 'overlay' engine converts the eps graphics once to a cached PDF base layer and typesets the replacements on top of it with pdflatex, which is much faster when only the replacements change.", choices=["psfrag", "overlay"], default="psfrag")
+
+    parser.add_argument("-t", "--timeout", help="Wall-clock timeout (in seconds) of each stage of the conversion (latex, dvips, ghostscript, etc). A stage that takes longer is killed and the file is marked as failed. Use 0 for no timeout (default: {0}).".format(DEFAULT_STAGE_LIMITS["latex"]["timeout"]), type=float)
+
+    parser.add_argument("--memory-limit", help="Maximum memory (in MB) of each stage of the conversion.", type=int, dest="memory_limit")
+
+    parser.add_argument("--cpu-limit", help="Maximum CPU time (in seconds) of each stage of the conversion.", type=int, dest="cpu_limit")
+
     # # nargs='+' means that one or more arguments are required
     # parser.add_argument("-f", "--file", help="Process the file FILE.eps. There must exist a FILE.psfrags text file.", nargs='+')
 
     parser.add_argument("NAMEs", help="Name(s) of the file(s) to be processed (without the extension). If the -f (--folder) option is passed then those names are actually treated as folder names instead of filenames. ", nargs="+")
     args = parser.parse_args()
 
+    # The same limits are used for all stages
+    memory_limit = args.memory_limit * 1024 * 1024 if args.memory_limit else None
+    stage_limits = {"timeout": args.timeout, "memory": memory_limit, "cpu": args.cpu_limit}
+    limits = dict((stage, stage_limits) for stage in DEFAULT_STAGE_LIMITS)
+
     # If the folder option was passed, we treat the names as folder names
     # and process all eps files (with have a bundled psfrags file) in each
     # folder.
     if args.folder_mode == True:
-        process_folders(args.NAMEs)
+        results = process_folders(args.NAMEs, args.engine, limits)
     # If the the folder option was not passes then we simple process all
     # files in NAMEs
     else:
-        process_files(args.NAMEs)
+        results = process_files(args.NAMEs, args.engine, limits)
+
+    # Exit with an error code if the conversion of any file failed
+    if any(exit_code != 0 for exit_code in results.values()):
+        sys.exit(1)
 
 
     #parser.print_help()